@@ -1,25 +1,48 @@
 from flask import (
     Flask,
+    before_render_template,
     flash,
+    g,
     jsonify,
     redirect,
     render_template,
     request,
     session,
+    template_rendered,
     url_for,
 )
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import click
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FSASession
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.sql.expression import ColumnElement
+from sqlalchemy.orm import Session as SASession
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from contextvars import ContextVar
+import atexit
 import os
 import json
 import re
+import threading
+import time
+import zlib
 
 # Gemini SDK
 from google import genai
 
+from ranking import ResourceIndex
+
 # -------------------- Config & Setup -------------------- #
 
 load_dotenv()
@@ -33,6 +56,15 @@ app = Flask(
 
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev-secret-key-change-in-prod")
 
+# Number of reverse proxies (e.g. the platform router in front of gunicorn)
+# whose X-Forwarded-* headers are trusted. Without this every client shares
+# the proxy's address, and so one per-IP login bucket.
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES, x_host=TRUSTED_PROXIES
+    )
+
 # Ensure the `instance/` directory exists and use it for the SQLite DB (Flask convention)
 instance_dir = os.path.join(os.path.dirname(__file__), "instance")
 os.makedirs(instance_dir, exist_ok=True)
@@ -40,17 +72,65 @@ os.makedirs(instance_dir, exist_ok=True)
 # Use instance/learning_path.db as the SQLite database file
 db_path = os.path.join(instance_dir, "learning_path.db")
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path.replace('\\\\', '/') }"
+# DATABASE_URL overrides the default file, e.g. "sqlite://" for a throwaway in-memory DB.
+if os.getenv("DATABASE_URL"):
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
-db = SQLAlchemy(app)
+# Optional per-user sharding. With SHARD_COUNT > 1 each user's chats, plans
+# and revisions live in one of N databases; the main database keeps the
+# `users` table as the directory (email -> id -> shard). Users without a
+# shard (created before sharding was enabled) keep their data in the main
+# database until `flask rebalance-shards` moves them.
+SHARD_COUNT = max(int(os.getenv("SHARD_COUNT", "1")), 1)
+# Shard databases to open. Keep this at the old count after lowering
+# SHARD_COUNT until `flask rebalance-shards` has drained the extra shards.
+SHARD_DATABASES = max(int(os.getenv("SHARD_DATABASES", SHARD_COUNT)), SHARD_COUNT)
+SHARD_DATABASE_URL = os.getenv(
+    "SHARD_DATABASE_URL",
+    "sqlite:///" + os.path.join(instance_dir, "learning_path_shard{shard}.db").replace("\\", "/"),
+)
+SHARDED_TABLES = {
+    "conversations", "chat_messages", "learning_plans", "plan_revisions", "chat_requests",
+    "llm_usage", "llm_usage_hourly", "ui_versions",
+}
+if SHARD_DATABASES > 1:
+    app.config["SQLALCHEMY_BINDS"] = {
+        f"shard{n}": SHARD_DATABASE_URL.format(shard=n) for n in range(SHARD_DATABASES)
+    }
+
+# Shard of the user whose data the current request/command works on.
+active_shard = ContextVar("active_shard", default=None)
+
+
+class ShardedSession(FSASession):
+    """Sends queries on per-user tables to the active shard's engine."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        shard = active_shard.get()
+        if bind is None and mapper is not None and shard is not None:
+            if sa_inspect(mapper).local_table.name in SHARDED_TABLES:
+                return db.engines[f"shard{shard}"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={"class_": ShardedSession})
 
 # -------------------- Gemini Client Setup -------------------- #
 
 GEMINI_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+# Point the SDK at another endpoint, e.g. the local fake_gemini.py server.
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+# When set, every call_ai_api prompt/response pair is appended to this JSONL file.
+LLM_RECORD_FILE = os.getenv("LLM_RECORD_FILE")
+record_lock = threading.Lock()
+
 ai_client = None
 if GEMINI_KEY:
     try:
-        ai_client = genai.Client(api_key=GEMINI_KEY)
+        http_options = {"base_url": GEMINI_BASE_URL} if GEMINI_BASE_URL else None
+        ai_client = genai.Client(api_key=GEMINI_KEY, http_options=http_options)
         print("✅ Gemini client initialized.")
     except Exception as e:
         print("❌ Gemini init failed, using stub:", e)
@@ -104,6 +184,8 @@ class User(db.Model):
     name = db.Column(db.String(120), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
+    # Shard holding this user's data; NULL means the main database.
+    shard = db.Column(db.Integer, nullable=True)
 
     plans = db.relationship("LearningPlan", backref="user", lazy=True)
     messages = db.relationship("ChatMessage", backref="user", lazy=True)
@@ -118,7 +200,19 @@ class Conversation(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Denormalized sidebar summary, updated with every chat_api insert.
+    last_message_preview = db.Column(db.String(160), nullable=True)
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    plan_id = db.Column(db.Integer, db.ForeignKey("learning_plans.id"), nullable=True)
+    # Set while a chat turn runs; see conversation_turn().
+    turn_started_at = db.Column(db.DateTime, nullable=True)
+
     messages = db.relationship("ChatMessage", backref="conversation", lazy=True)
+    plan = db.relationship("LearningPlan", lazy=True)
+
+    __table_args__ = (
+        db.Index("ix_conversations_user_updated", "user_id", "updated_at"),
+    )
 
 
 class LearningPlan(db.Model):
@@ -134,6 +228,31 @@ class LearningPlan(db.Model):
     path_json = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    revisions = db.relationship("PlanRevision", backref="plan", lazy=True)
+
+
+class PlanRevision(db.Model):
+    """An adjusted version of a LearningPlan (revision 0 is the plan itself).
+
+    `diff_json` is always relative to the original plan's path_json, so any
+    revision is rebuilt by applying a single diff.
+    """
+    __tablename__ = "plan_revisions"
+    id = db.Column(db.Integer, primary_key=True)
+    plan_id = db.Column(db.Integer, db.ForeignKey("learning_plans.id"), nullable=False)
+    revision = db.Column(db.Integer, nullable=False)
+
+    level = db.Column(db.String(50), nullable=False)
+    hours_per_week = db.Column(db.Integer, nullable=False)
+    duration_weeks = db.Column(db.Integer, nullable=False)
+
+    diff_json = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint("plan_id", "revision", name="uq_plan_revision"),
+    )
+
 
 class ChatMessage(db.Model):
     __tablename__ = "chat_messages"
@@ -144,13 +263,107 @@ class ChatMessage(db.Model):
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+
+class ChatRequest(db.Model):
+    """Result of an /api/chat call made with an idempotency key.
+
+    The row is inserted (claimed) before the turn runs and gets its
+    response when the turn finishes, so retries and duplicates with the same
+    key return the stored response instead of calling the AI again.
+    """
+    __tablename__ = "chat_requests"
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    idempotency_key = db.Column(db.String(64), nullable=False)
+    response_json = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "idempotency_key", name="uq_chat_request_key"),
+    )
+
+class UiVersion(db.Model):
+    """Bumped whenever the user's conversations/plans change; part of the
+    template fragment cache keys.
+    """
+    __tablename__ = "ui_versions"
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class LlmUsage(db.Model):
+    """One call_ai_api invocation (append-only, written in batches)."""
+    __tablename__ = "llm_usage"
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey("conversations.id"), nullable=True)
+    model = db.Column(db.String(80), nullable=False)
+    source = db.Column(db.String(20), nullable=False)  # "live", "stub" or "fallback"
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    output_tokens = db.Column(db.Integer, nullable=False, default=0)
+    latency_ms = db.Column(db.Float, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_llm_usage_user_created", "user_id", "created_at"),
+    )
+
+
+class LlmUsageHourly(db.Model):
+    """Per-user hourly totals of llm_usage, used for rolling windows and quotas."""
+    __tablename__ = "llm_usage_hourly"
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    hour = db.Column(db.DateTime, nullable=False)
+    calls = db.Column(db.Integer, nullable=False, default=0)
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    output_tokens = db.Column(db.Integer, nullable=False, default=0)
+    latency_ms = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "hour", name="uq_llm_usage_hourly"),
+    )
+
 # -------------------- Helper Utilities -------------------- #
 
 def current_user():
-    user_id = session.get("user_id")
-    if user_id:
-        return User.query.get(user_id)
-    return None
+    # Memoized per request: login_required, the view and inject_user all ask.
+    if "current_user" not in g:
+        user_id = session.get("user_id")
+        g.current_user = User.query.get(user_id) if user_id else None
+        if g.current_user is not None:
+            active_shard.set(g.current_user.shard)
+    return g.current_user
+
+
+@app.teardown_request
+def reset_active_shard(exc=None):
+    active_shard.set(None)
+
+
+@contextmanager
+def use_shard(shard):
+    """Route per-user tables to `shard` (None = main database) inside the block."""
+    token = active_shard.set(shard)
+    try:
+        yield
+    finally:
+        active_shard.reset(token)
+
+
+def shard_for_user(user_id):
+    """Initial placement for a new user: a stable hash of the id."""
+    if SHARD_COUNT == 1:
+        return None
+    return zlib.crc32(str(user_id).encode()) % SHARD_COUNT
+
+
+def shard_engine(shard):
+    if shard is None:
+        return db.engine
+    if shard >= SHARD_DATABASES:
+        raise RuntimeError(f"Shard {shard} is not configured (SHARD_DATABASES={SHARD_DATABASES}).")
+    return db.engines[f"shard{shard}"]
 
 
 def login_required(view_func):
@@ -162,6 +375,37 @@ def login_required(view_func):
     return wrapped
 
 
+PREVIEW_LENGTH = 120
+
+
+def add_chat_message(conversation, user_id, role, content):
+    """Add a ChatMessage and keep the conversation's sidebar summary in sync.
+
+    Nothing is committed here, so the message and the summary land in the
+    caller's transaction together.
+    """
+    msg = ChatMessage(
+        user_id=user_id,
+        conversation_id=conversation.id,
+        role=role,
+        content=content,
+    )
+    db.session.add(msg)
+
+    preview = " ".join(content.split())
+    if len(preview) > PREVIEW_LENGTH:
+        preview = preview[:PREVIEW_LENGTH - 1] + "…"
+    conversation.last_message_preview = preview
+    # Incremented in SQL so concurrent turns in other workers can't lose
+    # counts; a second message in the same flush adds to the pending expression.
+    count = conversation.message_count
+    if not isinstance(count, ColumnElement):
+        count = Conversation.message_count
+    conversation.message_count = count + 1
+    conversation.updated_at = datetime.utcnow()
+    return msg
+
+
 # -------------------- External Resources Loading -------------------- #
 try:
     resources_file = os.path.join(os.path.dirname(__file__), "data", "resources.json")
@@ -173,6 +417,9 @@ try:
 except Exception:
     RESOURCES = []
 
+RESOURCE_INDEX = ResourceIndex(RESOURCES)
+RESOURCES_PER_WEEK = 3
+
 
 def detect_goal_from_text(text: str) -> str:
     t = text.lower()
@@ -227,45 +474,20 @@ def detect_programming_language(text: str) -> str | None:
     return None
 
 
-def suggest_resources(goal, level, topic):
-    # Prefer externalized curated resources from data/resources.json if available.
-    try:
-        resources_list = RESOURCES  # loaded at module import
-    except NameError:
-        resources_list = []
+def suggest_resources(goal, level, topic, exclude=None, k=RESOURCES_PER_WEEK):
+    """Top-k resources for a week, ranked by TF-IDF relevance to goal + topic.
 
-    g = (goal or "").lower()
+    `exclude` holds ids already shown in earlier weeks; they are only reused
+    when there are not enough fresh matches.
+    """
     lvl = (level or "").lower()
 
-    matched = []
-
-    # Match resources by category and level
-    for r in resources_list:
-        try:
-            cats = [c.lower() for c in r.get("categories", [])]
-            r_level = (r.get("level") or "all").lower()
-
-            category_match = any(
-                (cat in g) or (cat in topic.lower()) or (cat in [x.lower() for x in [goal]])
-                for cat in cats
-            )
-
-            level_match = (r_level == "all") or (r_level == lvl) or (lvl == "")
+    indices = RESOURCE_INDEX.rank(goal, lvl, topic, k=k, exclude=exclude)
+    if not indices:
+        # Looser match: ignore the level filter.
+        indices = RESOURCE_INDEX.rank(goal, "", topic, k=k, exclude=exclude)
 
-            if category_match and level_match:
-                matched.append(r.copy())
-        except Exception:
-            continue
-
-    # If no matches found, try looser matching (category substring in goal)
-    if not matched and resources_list:
-        for r in resources_list:
-            try:
-                cats = [c.lower() for c in r.get("categories", [])]
-                if any(cat in g for cat in cats):
-                    matched.append(r.copy())
-            except Exception:
-                continue
+    matched = [RESOURCE_INDEX.resources[i].copy() for i in indices]
 
     # Fallback to small built-in suggestions if no external resources available
     if not matched:
@@ -287,7 +509,8 @@ def suggest_resources(goal, level, topic):
     return matched
 
 
-def generate_learning_path(profile):
+def plan_outline(profile):
+    """Weekly topics/hours/modes for a profile, without resources."""
     goal = profile["goal"]
     level = profile["level"]
     hours_per_week = profile["hours_per_week"]
@@ -346,19 +569,243 @@ def generate_learning_path(profile):
         topic, hours, mode = chosen[step_index]
         step_index += 1
 
-        base_resources = suggest_resources(goal, level, topic)
-
         path.append({
             "week": week,
             "step": len(path) + 1,
             "topic": topic,
             "hours": hours,
             "mode": mode,
-            "resources": base_resources,
         })
 
     return path
 
+
+def generate_learning_path(profile):
+    path = plan_outline(profile)
+    used = set()
+    for step in path:
+        step["resources"] = suggest_resources(
+            profile["goal"], profile["level"], step["topic"], exclude=used
+        )
+        used.update(resource_id(r) for r in step["resources"])
+    return path
+
+
+def resource_id(resource):
+    return resource.get("id") or resource.get("url") or resource.get("title")
+
+
+def revise_learning_path(old_steps, old_profile, new_profile):
+    """Rebuild a path for `new_profile`, reusing work from `old_steps`.
+
+    Only the outline is recomputed. Leading weeks that are unchanged (same
+    goal, level, topic, hours and mode) are kept as-is; resources are ranked
+    again only from the first changed week on, since each week avoids the
+    resources picked for the weeks before it.
+    """
+    reuse = (
+        old_profile["goal"] == new_profile["goal"]
+        and old_profile["level"].lower() == new_profile["level"].lower()
+    )
+
+    path = []
+    used = set()
+    for i, step in enumerate(plan_outline(new_profile)):
+        if reuse and i < len(old_steps) and all(old_steps[i].get(k) == step[k] for k in step):
+            step = old_steps[i]
+        else:
+            reuse = False
+            step["resources"] = suggest_resources(
+                new_profile["goal"], new_profile["level"], step["topic"], exclude=used
+            )
+        used.update(resource_id(r) for r in step["resources"])
+        path.append(step)
+
+    return path
+
+
+def diff_steps(base_steps, steps):
+    """Compact diff of `steps` against `base_steps`: new length + changed weeks."""
+    changed = {
+        str(i): step
+        for i, step in enumerate(steps)
+        if i >= len(base_steps) or base_steps[i] != step
+    }
+    return {"length": len(steps), "changed": changed}
+
+
+def apply_steps_diff(base_steps, diff):
+    changed = diff["changed"]
+    return [
+        changed[str(i)] if str(i) in changed else base_steps[i]
+        for i in range(diff["length"])
+    ]
+
+
+# There are only 168 hours in a week; huge values would also overflow
+# SQLite's INTEGER column on insert.
+MAX_HOURS_PER_WEEK = 168
+
+
+def normalize_profile(raw):
+    """Validate a plan profile dict and clamp weeks to the 4–6 range."""
+    goal = raw.get("goal") or ""
+    level = raw.get("level") or ""
+    if not isinstance(goal, str) or not isinstance(level, str):
+        raise ValueError("goal and level must be strings")
+    goal, level = goal.strip(), level.strip()
+    if not goal or not level:
+        raise ValueError("goal and level are required")
+
+    try:
+        hours = int(raw.get("hours_per_week", 5))
+        weeks = int(raw.get("duration_weeks", 4))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("hours_per_week and duration_weeks must be numbers")
+    if not 0 < hours <= MAX_HOURS_PER_WEEK:
+        raise ValueError(f"hours_per_week must be between 1 and {MAX_HOURS_PER_WEEK}")
+
+    if weeks < 4:
+        weeks = 4
+    elif weeks > 6:
+        weeks = 6
+
+    return {
+        "goal": goal,
+        "level": level,
+        "hours_per_week": hours,
+        "duration_weeks": weeks,
+    }
+
+
+def profile_key(profile):
+    # generate_learning_path only looks at the lowercased level, so
+    # "Beginner" and "beginner" share one generated path.
+    return (
+        profile["goal"],
+        profile["level"].lower(),
+        profile["hours_per_week"],
+        profile["duration_weeks"],
+    )
+
+
+def build_plans_batch(entries):
+    """Build LearningPlan rows for many (user_id, profile) pairs.
+
+    `generate_learning_path` runs once per unique profile and the serialized
+    path is shared by every learner with that profile. The caller adds the
+    returned rows to the session and commits them.
+    """
+    paths = {}
+    plans = []
+    for user_id, profile in entries:
+        key = profile_key(profile)
+        if key not in paths:
+            paths[key] = json.dumps(generate_learning_path(profile))
+
+        plans.append(LearningPlan(
+            user_id=user_id,
+            goal=profile["goal"],
+            level=profile["level"],
+            hours_per_week=profile["hours_per_week"],
+            duration_weeks=profile["duration_weeks"],
+            path_json=paths[key],
+        ))
+
+    return plans, len(paths)
+
+
+def create_plans_for_cohort(items):
+    """Resolve learners by email, then bulk-create their plans.
+
+    `items` is a list of dicts with `email` plus the profile fields.
+    Returns (created, unique_profiles, errors) where `created` is a list of
+    {"email", "plan_id"} dicts. Each shard is committed separately, so if one
+    shard fails its items are reported in `errors` and the others are kept.
+    """
+    errors = []
+    emails = {
+        item["email"].strip().lower()
+        for item in items
+        if isinstance(item, dict) and isinstance(item.get("email"), str)
+    }
+    emails.discard("")
+    users = {}
+    if emails:
+        users = {
+            u.email: (u.id, u.shard)
+            for u in User.query.filter(User.email.in_(emails)).all()
+        }
+
+    entries = []
+    entry_indexes = []
+    entry_emails = []
+    entry_shards = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({"index": index, "error": "Each item must be an object."})
+            continue
+
+        email = item.get("email") or ""
+        if not isinstance(email, str):
+            errors.append({"index": index, "error": "email must be a string."})
+            continue
+        email = email.strip().lower()
+        if email not in users:
+            errors.append({"index": index, "email": email, "error": "Unknown user."})
+            continue
+        user_id, shard = users[email]
+
+        try:
+            profile = normalize_profile(item)
+        except (TypeError, ValueError) as e:
+            errors.append({"index": index, "email": email, "error": str(e)})
+            continue
+
+        entries.append((user_id, profile))
+        entry_indexes.append(index)
+        entry_emails.append(email)
+        entry_shards.append(shard)
+
+    plans, unique_profiles = build_plans_batch(entries)
+
+    # One transaction per shard; ids are read before leaving it.
+    plan_ids = {}
+    for shard in dict.fromkeys(entry_shards):
+        indexes = [i for i, s in enumerate(entry_shards) if s == shard]
+        with use_shard(shard):
+            db.session.add_all([plans[i] for i in indexes])
+            try:
+                db.session.commit()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                print(f"❌ Could not save batch plans on shard {shard}:", e)
+                for i in indexes:
+                    errors.append({
+                        "index": entry_indexes[i],
+                        "email": entry_emails[i],
+                        "error": "Could not save the plan; try again.",
+                    })
+                continue
+            for i in indexes:
+                plan_ids[i] = plans[i].id
+                # Ids repeat across shards; keep the identity map unambiguous.
+                db.session.expunge(plans[i])
+
+    created = [
+        {"email": email, "plan_id": plan_ids[i]}
+        for i, email in enumerate(entry_emails)
+        if i in plan_ids
+    ]
+    errors.sort(key=lambda error: error["index"])
+    return created, unique_profiles, errors
+
+
+def is_instructor(user):
+    instructors = os.getenv("INSTRUCTOR_EMAILS", "")
+    allowed = {e.strip().lower() for e in instructors.split(",") if e.strip()}
+    return bool(user) and user.email in allowed
+
 # -------------------- AI: Stub + Gemini -------------------- #
 
 def call_ai_api_stub(history):
@@ -478,34 +925,521 @@ def call_ai_api_stub(history):
     )
 
 
-def call_ai_api(history):
+def build_prompt(history):
+    convo_lines = []
+    for msg in history:
+        prefix = "User" if msg["role"] == "user" else "Assistant"
+        convo_lines.append(f"{prefix}: {msg['content']}")
+    conversation_text = "\n".join(convo_lines)
+
+    return SYSTEM_INSTRUCTIONS + "\n\nConversation so far:\n" + conversation_text
+
+
+def record_llm_call(prompt, text, latency_ms, source):
+    """Append one prompt/response pair to LLM_RECORD_FILE (JSONL), if set."""
+    if not LLM_RECORD_FILE:
+        return
+    entry = {
+        "prompt": prompt,
+        "response": text,
+        "latency_ms": round(latency_ms, 2),
+        "model": GEMINI_MODEL,
+        "source": source,
+        "recorded_at": datetime.utcnow().isoformat(),
+    }
+    line = json.dumps(entry, ensure_ascii=False)
+    with record_lock:
+        with open(LLM_RECORD_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def call_ai_api(history, user_id=None, conversation_id=None):
+    """Ask Gemini (or the stub) for the next reply.
+
+    With a user_id, the call's tokens and latency are added to the usage
+    accounting for that user and conversation.
+    """
     print("🧠 Calling Gemini AI...")
 
+    full_prompt = build_prompt(history)
+    started = time.perf_counter()
+
     if not ai_client:
         print("➡️ No Gemini client, using stub.")
-        return call_ai_api_stub(history)
+        text = call_ai_api_stub(history)
+        latency_ms = (time.perf_counter() - started) * 1000
+        record_llm_call(full_prompt, text, latency_ms, "stub")
+        record_usage(user_id, conversation_id, "stub", estimate_tokens(full_prompt),
+                     estimate_tokens(text), latency_ms)
+        return text
 
     try:
-        convo_lines = []
-        for msg in history:
-            prefix = "User" if msg["role"] == "user" else "Assistant"
-            convo_lines.append(f"{prefix}: {msg['content']}")
-        conversation_text = "\n".join(convo_lines)
-
-        full_prompt = SYSTEM_INSTRUCTIONS + "\n\nConversation so far:\n" + conversation_text
-
         response = ai_client.models.generate_content(
-            model="gemini-2.5-flash",
+            model=GEMINI_MODEL,
             contents=full_prompt,
         )
 
         text = (response.text or "").strip()
         print("🤖 Gemini raw response:", text)
+        latency_ms = (time.perf_counter() - started) * 1000
+        record_llm_call(full_prompt, text, latency_ms, "live")
+
+        usage = response.usage_metadata
+        if usage is not None:
+            prompt_tokens = usage.prompt_token_count or 0
+            # Thinking tokens are billed as output.
+            output_tokens = (usage.candidates_token_count or 0) + (usage.thoughts_token_count or 0)
+        else:
+            prompt_tokens, output_tokens = estimate_tokens(full_prompt), estimate_tokens(text)
+        record_usage(user_id, conversation_id, "live", prompt_tokens, output_tokens, latency_ms)
         return text
 
     except Exception as e:
         print("❌ Gemini error, using stub:", e)
-        return call_ai_api_stub(history)
+        text = call_ai_api_stub(history)
+        record_usage(user_id, conversation_id, "fallback", estimate_tokens(full_prompt),
+                     estimate_tokens(text), (time.perf_counter() - started) * 1000)
+        return text
+
+# -------------------- Usage Accounting -------------------- #
+
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "100"))
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "2"))
+# Rolling window for /api/usage and the quotas below (0 = no limit).
+USAGE_WINDOW_HOURS = int(os.getenv("USAGE_WINDOW_HOURS", "24"))
+USAGE_QUOTA_TOKENS = int(os.getenv("USAGE_QUOTA_TOKENS", "0"))
+USAGE_QUOTA_CALLS = int(os.getenv("USAGE_QUOTA_CALLS", "0"))
+
+
+class UsageQuotaExceeded(Exception):
+    pass
+
+
+def estimate_tokens(text):
+    # Rough size for calls without usage metadata (stub, fallback).
+    return max(len(text or "") // 4, 1)
+
+
+def usage_hour(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+class UsageRecorder:
+    """Buffers usage rows and writes them in batches from a background thread.
+
+    A batch is written every USAGE_FLUSH_SECONDS, or as soon as
+    USAGE_BATCH_SIZE rows are waiting. Each write inserts the raw rows and
+    updates the hourly totals of the shard the rows belong to.
+    """
+
+    def __init__(self, batch_size, flush_seconds):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.writing = []
+        self.wake = threading.Event()
+        self.thread = None
+
+    def add(self, row):
+        with self.lock:
+            self.pending.append(row)
+            if self.thread is None:
+                # Started lazily so forked web workers each get their own.
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if len(self.pending) >= self.batch_size:
+                self.wake.set()
+
+    def unwritten_for(self, user_id):
+        """Rows recorded for a user that are not in the database yet."""
+        with self.lock:
+            return [r for r in self.pending + self.writing if r["user_id"] == user_id]
+
+    def run(self):
+        while True:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                self.writing, self.pending = self.pending, []
+            try:
+                if self.writing:
+                    with app.app_context():
+                        self.write(self.writing)
+            except Exception as e:
+                print("❌ Could not write usage batch:", e)
+            finally:
+                with self.lock:
+                    self.writing = []
+
+    def write(self, rows):
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(row["shard"], []).append(row)
+
+        for shard, shard_rows in by_shard.items():
+            hourly = {}
+            for row in shard_rows:
+                key = (row["user_id"], usage_hour(row["created_at"]))
+                totals = hourly.setdefault(key, [0, 0, 0, 0.0])
+                totals[0] += 1
+                totals[1] += row["prompt_tokens"]
+                totals[2] += row["output_tokens"]
+                totals[3] += row["latency_ms"]
+
+            columns = LlmUsage.__table__.c.keys()
+            with shard_engine(shard).begin() as conn:
+                conn.execute(db.insert(LlmUsage.__table__), [
+                    {k: v for k, v in row.items() if k in columns} for row in shard_rows
+                ])
+                table = LlmUsageHourly.__table__
+                for (user_id, hour), (calls, prompt, output, latency) in hourly.items():
+                    stmt = sqlite_insert(table).values(
+                        user_id=user_id, hour=hour, calls=calls, prompt_tokens=prompt,
+                        output_tokens=output, latency_ms=latency,
+                    )
+                    conn.execute(stmt.on_conflict_do_update(
+                        index_elements=["user_id", "hour"],
+                        set_={
+                            "calls": table.c.calls + stmt.excluded.calls,
+                            "prompt_tokens": table.c.prompt_tokens + stmt.excluded.prompt_tokens,
+                            "output_tokens": table.c.output_tokens + stmt.excluded.output_tokens,
+                            "latency_ms": table.c.latency_ms + stmt.excluded.latency_ms,
+                        },
+                    ))
+
+
+usage_recorder = UsageRecorder(USAGE_BATCH_SIZE, USAGE_FLUSH_SECONDS)
+atexit.register(usage_recorder.flush)
+
+
+def record_usage(user_id, conversation_id, source, prompt_tokens, output_tokens, latency_ms):
+    if user_id is None:
+        return
+    usage_recorder.add({
+        "shard": active_shard.get(),
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "model": "stub" if source == "stub" else GEMINI_MODEL,
+        "source": source,
+        "prompt_tokens": int(prompt_tokens),
+        "output_tokens": int(output_tokens),
+        "latency_ms": round(latency_ms, 2),
+        "created_at": datetime.utcnow(),
+    })
+
+
+def usage_totals(user_id, hours=USAGE_WINDOW_HOURS):
+    """The user's calls, tokens and latency over the last `hours` (hour granularity)."""
+    since = usage_hour(datetime.utcnow() - timedelta(hours=hours - 1))
+    row = db.session.execute(
+        db.select(
+            db.func.coalesce(db.func.sum(LlmUsageHourly.calls), 0),
+            db.func.coalesce(db.func.sum(LlmUsageHourly.prompt_tokens), 0),
+            db.func.coalesce(db.func.sum(LlmUsageHourly.output_tokens), 0),
+            db.func.coalesce(db.func.sum(LlmUsageHourly.latency_ms), 0),
+        ).where(LlmUsageHourly.user_id == user_id, LlmUsageHourly.hour >= since)
+    ).one()
+    calls, prompt_tokens, output_tokens, latency_ms = row
+    # Rows still waiting in the batch buffer count too, so a burst cannot
+    # overrun a quota between two flushes.
+    for r in usage_recorder.unwritten_for(user_id):
+        calls += 1
+        prompt_tokens += r["prompt_tokens"]
+        output_tokens += r["output_tokens"]
+        latency_ms += r["latency_ms"]
+    return {
+        "calls": calls,
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": prompt_tokens + output_tokens,
+        "avg_latency_ms": round(latency_ms / calls, 2) if calls else 0,
+    }
+
+
+def check_usage_quota(user_id):
+    """Raise UsageQuotaExceeded if the user has used up a quota in the window."""
+    if not USAGE_QUOTA_TOKENS and not USAGE_QUOTA_CALLS:
+        return
+    totals = usage_totals(user_id)
+    if USAGE_QUOTA_CALLS and totals["calls"] >= USAGE_QUOTA_CALLS:
+        raise UsageQuotaExceeded(
+            f"You have reached the limit of {USAGE_QUOTA_CALLS} AI replies "
+            f"per {USAGE_WINDOW_HOURS} hours. Please try again later."
+        )
+    if USAGE_QUOTA_TOKENS and totals["total_tokens"] >= USAGE_QUOTA_TOKENS:
+        raise UsageQuotaExceeded(
+            f"You have reached the limit of {USAGE_QUOTA_TOKENS} AI tokens "
+            f"per {USAGE_WINDOW_HOURS} hours. Please try again later."
+        )
+
+
+@app.errorhandler(UsageQuotaExceeded)
+def usage_quota_exceeded(e):
+    return jsonify({"error": str(e), "reply": str(e), "plan_ready": False}), 429
+
+@app.route("/api/usage")
+@login_required
+def usage_api():
+    """The user's AI usage in the rolling window, with the costliest conversations."""
+    user = current_user()
+    hours = min(max(request.args.get("hours", USAGE_WINDOW_HOURS, type=int), 1), 24 * 90)
+    since = datetime.utcnow() - timedelta(hours=hours)
+
+    total_tokens = db.func.sum(LlmUsage.prompt_tokens + LlmUsage.output_tokens)
+    rows = db.session.execute(
+        db.select(
+            LlmUsage.conversation_id,
+            Conversation.title,
+            db.func.count(),
+            total_tokens,
+            db.func.avg(LlmUsage.latency_ms),
+        )
+        .outerjoin(Conversation, Conversation.id == LlmUsage.conversation_id)
+        .where(LlmUsage.user_id == user.id, LlmUsage.created_at >= since)
+        .group_by(LlmUsage.conversation_id, Conversation.title)
+        .order_by(total_tokens.desc())
+        .limit(10)
+    ).all()
+
+    return jsonify({
+        "window_hours": hours,
+        "totals": usage_totals(user.id, hours),
+        "quota": {
+            "window_hours": USAGE_WINDOW_HOURS,
+            "calls": USAGE_QUOTA_CALLS or None,
+            "tokens": USAGE_QUOTA_TOKENS or None,
+        },
+        "conversations": [
+            {
+                "conversation_id": conv_id,
+                "title": title,
+                "calls": calls,
+                "total_tokens": tokens,
+                "avg_latency_ms": round(latency or 0, 2),
+            }
+            for conv_id, title, calls, tokens, latency in rows
+        ],
+    })
+
+
+@app.cli.command("usage-report")
+@click.option("--hours", default=USAGE_WINDOW_HOURS, show_default=True)
+@click.option("--top", default=20, show_default=True, help="Number of users to list.")
+def usage_report_command(hours, top):
+    """List the users with the most AI tokens in the last HOURS, across shards."""
+    usage_recorder.flush()
+    since = usage_hour(datetime.utcnow() - timedelta(hours=hours - 1))
+    table = LlmUsageHourly.__table__
+    query = (
+        db.select(
+            table.c.user_id,
+            db.func.sum(table.c.calls),
+            db.func.sum(table.c.prompt_tokens),
+            db.func.sum(table.c.output_tokens),
+            db.func.sum(table.c.latency_ms),
+        )
+        .where(table.c.hour >= since)
+        .group_by(table.c.user_id)
+    )
+
+    totals = []
+    for shard in shard_locations():
+        with shard_engine(shard).connect() as conn:
+            totals.extend(conn.execute(query).all())
+    totals.sort(key=lambda r: r[2] + r[3], reverse=True)
+    totals = totals[:top]
+
+    emails = dict(db.session.execute(
+        db.select(User.id, User.email).where(User.id.in_([r[0] for r in totals]))
+    ).all())
+    for user_id, calls, prompt, output, latency in totals:
+        click.echo(
+            f"{emails.get(user_id, user_id)}: {calls} calls, "
+            f"{prompt} prompt + {output} output tokens, "
+            f"avg {latency / calls:.0f} ms"
+        )
+
+# -------------------- Request Coalescing -------------------- #
+
+class SingleFlight:
+    """Run at most one call per key; concurrent callers share its result.
+
+    In-process only: callers in other worker processes are not merged.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call["done"].set()
+
+
+chat_flights = SingleFlight()
+
+# How long a duplicate request waits for the original to finish.
+IDEMPOTENCY_WAIT_SECONDS = 60
+# A claim this old without a response was abandoned (its worker died
+# mid-turn), so the next retry takes it over.
+IDEMPOTENCY_STALE_SECONDS = 2 * IDEMPOTENCY_WAIT_SECONDS
+# Answered keys are kept this long for retries, then pruned.
+IDEMPOTENCY_KEEP_HOURS = int(os.getenv("IDEMPOTENCY_KEEP_HOURS", "24"))
+IDEMPOTENCY_PRUNE_SECONDS = 600
+last_idempotency_prune = {}
+
+
+class ConversationBusy(Exception):
+    pass
+
+
+def claim_conversation_turn(conversation_id):
+    """Mark the conversation as having a turn in progress.
+
+    The claim lives in the database, so it holds across worker processes.
+    A claim older than IDEMPOTENCY_STALE_SECONDS belonged to a worker that
+    died mid-turn and is taken over. Returns True if this caller got it.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=IDEMPOTENCY_STALE_SECONDS)
+    result = db.session.execute(
+        db.update(Conversation)
+        .where(Conversation.id == conversation_id)
+        .where(db.or_(
+            Conversation.turn_started_at.is_(None),
+            Conversation.turn_started_at < stale,
+        ))
+        .values(turn_started_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+@contextmanager
+def conversation_turn(conversation_id):
+    """Run one chat turn at a time per conversation, across all workers."""
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while not claim_conversation_turn(conversation_id):
+        if time.monotonic() >= deadline:
+            raise ConversationBusy(
+                "The previous message in this chat is still being answered. "
+                "Please try again in a moment."
+            )
+        time.sleep(0.2)
+    try:
+        yield
+    finally:
+        db.session.rollback()
+        db.session.execute(
+            db.update(Conversation)
+            .where(Conversation.id == conversation_id)
+            .values(turn_started_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+
+@app.errorhandler(ConversationBusy)
+def conversation_busy(e):
+    return jsonify({"error": str(e), "reply": str(e), "plan_ready": False}), 409
+
+
+def prune_idempotency_keys():
+    """Delete old chat_requests rows, at most once per shard every few minutes."""
+    shard = active_shard.get()
+    now = time.monotonic()
+    if now - last_idempotency_prune.get(shard, float("-inf")) < IDEMPOTENCY_PRUNE_SECONDS:
+        return
+    last_idempotency_prune[shard] = now
+    cutoff = datetime.utcnow() - timedelta(hours=IDEMPOTENCY_KEEP_HOURS)
+    ChatRequest.query.filter(ChatRequest.created_at < cutoff).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+
+
+def claim_idempotency_key(user_id, key):
+    """Try to claim a key. Returns (claimed, stored_response).
+
+    If another request already holds the key, wait for its response; the
+    response is None if it did not finish in time. Abandoned claims are
+    taken over.
+    """
+    prune_idempotency_keys()
+    db.session.add(ChatRequest(user_id=user_id, idempotency_key=key))
+    try:
+        db.session.commit()
+        return True, None
+    except IntegrityError:
+        db.session.rollback()
+
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        row = ChatRequest.query.filter_by(user_id=user_id, idempotency_key=key).first()
+        if row is not None and row.response_json is not None:
+            return False, json.loads(row.response_json)
+        if row is None:
+            return False, None
+
+        stale_before = datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_STALE_SECONDS)
+        if row.created_at is None or row.created_at < stale_before:
+            # Only one waiter wins the update if several retry at once.
+            taken = ChatRequest.query.filter_by(
+                id=row.id, response_json=None, created_at=row.created_at
+            ).update({"created_at": datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+            if taken:
+                return True, None
+            continue
+
+        if time.monotonic() >= deadline:
+            return False, None
+        # End the read transaction so the next poll sees new commits.
+        db.session.rollback()
+        time.sleep(0.1)
+
+
+def store_idempotent_response(user_id, key, response):
+    ChatRequest.query.filter_by(user_id=user_id, idempotency_key=key).update(
+        {"response_json": json.dumps(response)}
+    )
+    db.session.commit()
+
+
+def release_idempotency_key(user_id, key):
+    db.session.rollback()
+    ChatRequest.query.filter_by(
+        user_id=user_id, idempotency_key=key, response_json=None
+    ).delete()
+    db.session.commit()
 
 # -------------------- Template Context -------------------- #
 
@@ -513,6 +1447,240 @@ def call_ai_api(history):
 def inject_user():
     return {"user": current_user()}
 
+
+def current_ui_version(user):
+    """Fragment cache version for `user`.
+
+    Views read it before their data queries: a write that lands in between
+    then bumps the version past the cached fragment instead of leaving old
+    data cached under the new version.
+    """
+    row = db.session.get(UiVersion, user.id)
+    return row.version if row else 0
+
+
+def bump_ui_versions_stmt(user_ids):
+    table = UiVersion.__table__
+    stmt = sqlite_insert(table).values([{"user_id": u, "version": 1} for u in user_ids])
+    return stmt.on_conflict_do_update(
+        index_elements=["user_id"], set_={"version": table.c.version + 1}
+    )
+
+
+# Compiled templates are kept on disk, so restarted workers skip recompiling.
+jinja_cache_dir = os.path.join(instance_dir, "jinja_cache")
+os.makedirs(jinja_cache_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
+
+
+class FragmentCache:
+    """Small in-process LRU of rendered template fragments."""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+fragment_cache = FragmentCache(int(os.getenv("FRAGMENT_CACHE_SIZE", "2048")))
+
+
+@app.template_global()
+def cache_fragment(name, *key, caller):
+    """Jinja `{% call cache_fragment("name", key...) %}...{% endcall %}` block.
+
+    Keys for per-user data should include `current_ui_version(user)`, read by
+    the view, so writes invalidate them.
+    """
+    full_key = (name,) + key
+    html = fragment_cache.get(full_key)
+    if html is None:
+        html = caller()
+        fragment_cache.set(full_key, html)
+    return html
+
+
+@db.event.listens_for(SASession, "before_flush")
+def bump_ui_version(sess, flush_context, instances):
+    user_ids = {
+        obj.user_id
+        for obj in list(sess.new) + list(sess.dirty) + list(sess.deleted)
+        if isinstance(obj, (Conversation, LearningPlan, ChatMessage))
+    }
+    # Revisions only know their plan; the plan's owner sees the change.
+    with sess.no_autoflush:
+        for obj in sess.new:
+            if isinstance(obj, PlanRevision):
+                plan = sess.get(LearningPlan, obj.plan_id)
+                if plan is not None:
+                    user_ids.add(plan.user_id)
+    if user_ids:
+        # Same shard and transaction as the rows being flushed.
+        sess.execute(
+            bump_ui_versions_stmt(sorted(user_ids)),
+            bind_arguments={"mapper": UiVersion},
+        )
+
+
+# Per-template render timings, exposed as a Server-Timing header.
+TEMPLATE_SLOW_MS = float(os.getenv("TEMPLATE_SLOW_MS", "50"))
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault("template_starts", []).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def record_template_time(sender, template, context, **extra):
+    starts = g.get("template_starts")
+    if not starts:
+        return
+    elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+    g.setdefault("template_timings", []).append((template.name, elapsed_ms))
+    if elapsed_ms > TEMPLATE_SLOW_MS:
+        print(f"🐢 Slow render: {template.name} took {elapsed_ms:.1f} ms")
+
+
+@app.after_request
+def add_server_timing(response):
+    timings = g.get("template_timings")
+    if timings:
+        response.headers.add("Server-Timing", ", ".join(
+            f'render;desc="{name}";dur={ms:.1f}' for name, ms in timings
+        ))
+    return response
+
+# -------------------- Password Hashing & Login Throttling -------------------- #
+
+# Any werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000".
+# Changing it upgrades existing hashes on each user's next successful login.
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# Hash jobs allowed to run or wait at once; beyond this, auth is turned away.
+# Each one holds a web server thread while it waits, so keep it well below
+# the threads per gunicorn worker (32 in the Procfile) to leave room for
+# other requests. Like the pool and the rate limiters, it is per process.
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", str(PASSWORD_HASH_WORKERS * 8)))
+
+# The method prefix werkzeug writes for PASSWORD_HASH_METHOD (defaults filled in).
+CURRENT_HASH_PREFIX = generate_password_hash("", PASSWORD_HASH_METHOD).split("$", 1)[0]
+
+hash_pool = None
+hash_pool_lock = threading.Lock()
+hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE)
+
+
+class HashPoolBusy(Exception):
+    pass
+
+
+def get_hash_pool():
+    # Created lazily so every gunicorn worker gets its own pool after fork.
+    global hash_pool
+    with hash_pool_lock:
+        if hash_pool is None:
+            hash_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+            atexit.register(hash_pool.shutdown, wait=False, cancel_futures=True)
+        return hash_pool
+
+
+def run_hash_job(fn, *args):
+    """Run a CPU-heavy hash function in the process pool, off the request worker."""
+    if not hash_slots.acquire(blocking=False):
+        raise HashPoolBusy()
+    try:
+        return get_hash_pool().submit(fn, *args).result()
+    except BrokenProcessPool:
+        # A crashed pool is rebuilt on the next call; do this one inline.
+        global hash_pool
+        with hash_pool_lock:
+            hash_pool = None
+        return fn(*args)
+    finally:
+        hash_slots.release()
+
+
+def hash_password(password):
+    return run_hash_job(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+def verify_password(password_hash, password):
+    return run_hash_job(check_password_hash, password_hash, password)
+
+
+def password_needs_rehash(password_hash):
+    return password_hash.split("$", 1)[0] != CURRENT_HASH_PREFIX
+
+
+class TokenBucket:
+    """In-process token buckets: `capacity` burst, refilled at `rate` per second."""
+
+    MAX_KEYS = 10000
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.MAX_KEYS:
+                self.prune(now)
+            return allowed
+
+    def prune(self, now):
+        # Forget buckets that have refilled completely; they behave like new ones.
+        full = [
+            k for k, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate >= self.capacity
+        ]
+        for k in full:
+            del self.buckets[k]
+
+
+# A whole class may log in from one school IP, so the per-IP bucket is roomy;
+# the per-email bucket is what stops password guessing.
+ip_auth_limiter = TokenBucket(
+    capacity=int(os.getenv("AUTH_IP_BURST", "60")),
+    rate=float(os.getenv("AUTH_IP_PER_MINUTE", "120")) / 60,
+)
+email_auth_limiter = TokenBucket(
+    capacity=int(os.getenv("AUTH_EMAIL_BURST", "5")),
+    rate=float(os.getenv("AUTH_EMAIL_PER_MINUTE", "5")) / 60,
+)
+
+
+def auth_allowed(email):
+    """Rate-limit check done before any password hashing work."""
+    if not ip_auth_limiter.allow(request.remote_addr or "unknown"):
+        return False
+    if email and not email_auth_limiter.allow(email):
+        return False
+    return True
+
 # -------------------- Routes: Auth -------------------- #
 
 @app.route("/")
@@ -527,6 +1695,10 @@ def register():
         email = request.form.get("email", "").strip().lower()
         password = request.form.get("password", "")
 
+        if not auth_allowed(email):
+            flash("Too many attempts. Please wait a minute and try again.")
+            return render_template("register.html"), 429
+
         if not name or not email or not password:
             flash("All fields are required.")
             return redirect(url_for("register"))
@@ -539,12 +1711,20 @@ def register():
             flash("Password must be at least 6 characters.")
             return redirect(url_for("register"))
 
+        try:
+            password_hash = hash_password(password)
+        except HashPoolBusy:
+            flash("The server is busy. Please try again in a moment.")
+            return render_template("register.html"), 503
+
         user = User(
             name=name,
             email=email,
-            password_hash=generate_password_hash(password),
+            password_hash=password_hash,
         )
         db.session.add(user)
+        db.session.flush()
+        user.shard = shard_for_user(user.id)
         db.session.commit()
 
         session["user_id"] = user.id
@@ -560,8 +1740,26 @@ def login():
         email = request.form.get("email", "").strip().lower()
         password = request.form.get("password", "")
 
+        if not auth_allowed(email):
+            flash("Too many login attempts. Please wait a minute and try again.")
+            return render_template("login.html"), 429
+
         user = User.query.filter_by(email=email).first()
-        if not user or not check_password_hash(user.password_hash, password):
+        try:
+            valid = bool(user) and verify_password(user.password_hash, password)
+        except HashPoolBusy:
+            flash("The server is busy. Please try again in a moment.")
+            return render_template("login.html"), 503
+
+        if valid and password_needs_rehash(user.password_hash):
+            try:
+                user.password_hash = hash_password(password)
+                db.session.commit()
+            except HashPoolBusy:
+                # Already authenticated; upgrade the hash on a later login.
+                pass
+
+        if not valid:
             flash("Invalid credentials.")
             return redirect(url_for("login"))
 
@@ -584,6 +1782,7 @@ def logout():
 @login_required
 def dashboard():
     user = current_user()
+    ui_version = current_ui_version(user)
 
     conv_id = request.args.get("conversation_id", type=int)
 
@@ -640,6 +1839,7 @@ def dashboard():
         conversations=conversations,
         active_conversation=active_conversation,
         plans=plans,   # ✅ yahan se tum history UI mein dikha sakte ho
+        ui_version=ui_version,
     )
 
 
@@ -690,15 +1890,134 @@ def learning_path(plan_id=None):
             flash("No learning path yet. Use the chatbot on the dashboard to create one.")
             return redirect(url_for("dashboard"))
 
-    steps = json.loads(plan.path_json)
+    revision = request.args.get("revision", type=int)
+    loaded = load_plan_revision(plan, revision)
+    if loaded is None:
+        flash("That plan revision was not found.")
+        return redirect(url_for("learning_path", plan_id=plan.id))
+    profile, steps, revision = loaded
+
+    return render_template(
+        "learning_path.html", profile=profile, path=steps, plan=plan, revision=revision
+    )
+
+
+def load_plan_revision(plan, revision=None):
+    """Return (profile, steps, revision) for a plan; latest revision by default.
+
+    Returns None if the requested revision does not exist.
+    """
+    base_steps = json.loads(plan.path_json)
+    query = PlanRevision.query.filter_by(plan_id=plan.id)
+    if revision is None:
+        rev = query.order_by(PlanRevision.revision.desc()).first()
+    elif revision == 0:
+        rev = None
+    else:
+        rev = query.filter_by(revision=revision).first()
+        if rev is None:
+            return None
+
+    if rev is None:
+        profile = {
+            "goal": plan.goal,
+            "level": plan.level,
+            "hours_per_week": plan.hours_per_week,
+            "duration_weeks": plan.duration_weeks,
+        }
+        return profile, base_steps, 0
+
     profile = {
         "goal": plan.goal,
-        "level": plan.level,
-        "hours_per_week": plan.hours_per_week,
-        "duration_weeks": plan.duration_weeks,
+        "level": rev.level,
+        "hours_per_week": rev.hours_per_week,
+        "duration_weeks": rev.duration_weeks,
     }
+    return profile, apply_steps_diff(base_steps, json.loads(rev.diff_json)), rev.revision
+
+
+PLAN_REVISION_ATTEMPTS = 3
 
-    return render_template("learning_path.html", profile=profile, path=steps, plan=plan)
+
+@app.route("/api/plans/<int:plan_id>/revisions", methods=["POST"])
+@login_required
+def create_plan_revision_api(plan_id):
+    user = current_user()
+    plan = LearningPlan.query.filter_by(id=plan_id, user_id=user.id).first()
+    if not plan:
+        return jsonify({"error": "Plan not found."}), 404
+
+    data = request.get_json(force=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Send a JSON object."}), 400
+    if "level" in data and not isinstance(data["level"], str):
+        return jsonify({"error": "level must be a string."}), 400
+    # Two requests can both build on the same latest revision; the loser
+    # of the uq_plan_revision race rebuilds on top of the winner's.
+    for _ in range(PLAN_REVISION_ATTEMPTS):
+        old_profile, old_steps, old_revision = load_plan_revision(plan)
+
+        try:
+            new_profile = normalize_profile({
+                "goal": old_profile["goal"],
+                "level": data.get("level") or old_profile["level"],
+                "hours_per_week": data.get("hours_per_week", old_profile["hours_per_week"]),
+                "duration_weeks": data.get("duration_weeks", old_profile["duration_weeks"]),
+            })
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+
+        if new_profile == old_profile:
+            return jsonify({"revision": old_revision, "steps": old_steps, "changed_weeks": []})
+
+        steps = revise_learning_path(old_steps, old_profile, new_profile)
+        base_steps = json.loads(plan.path_json)
+        diff = diff_steps(base_steps, steps)
+
+        rev = PlanRevision(
+            plan_id=plan.id,
+            revision=old_revision + 1,
+            level=new_profile["level"],
+            hours_per_week=new_profile["hours_per_week"],
+            duration_weeks=new_profile["duration_weeks"],
+            diff_json=json.dumps(diff),
+        )
+        db.session.add(rev)
+        try:
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+    else:
+        return jsonify({"error": "The plan is being changed by another request; try again."}), 409
+
+    # Weeks added, altered or dropped compared with the previous revision.
+    changed_weeks = [
+        step["week"] for i, step in enumerate(steps)
+        if i >= len(old_steps) or old_steps[i] != step
+    ] + [step["week"] for step in old_steps[len(steps):]]
+    return jsonify({
+        "revision": rev.revision,
+        "profile": new_profile,
+        "steps": steps,
+        "changed_weeks": changed_weeks,
+    })
+
+
+@app.route("/api/plans/<int:plan_id>/revisions/<int:revision>")
+@login_required
+def get_plan_revision_api(plan_id, revision):
+    user = current_user()
+    plan = LearningPlan.query.filter_by(id=plan_id, user_id=user.id).first()
+    if not plan:
+        return jsonify({"error": "Plan not found."}), 404
+
+    loaded = load_plan_revision(plan, revision)
+    if loaded is None:
+        return jsonify({"error": "Revision not found."}), 404
+    profile, steps, revision = loaded
+
+    return jsonify({"revision": revision, "profile": profile, "steps": steps})
 
 
 @app.route("/api/chat", methods=["POST"])
@@ -708,49 +2027,87 @@ def chat_api():
     data = request.get_json(force=True) or {}
     user_message = (data.get("message") or "").strip()
     conv_id = data.get("conversation_id")
+    idempotency_key = (
+        request.headers.get("Idempotency-Key") or data.get("idempotency_key") or ""
+    ).strip()[:64]
 
     if not user_message:
         return jsonify({"reply": "Please type a message first.", "plan_ready": False})
 
+    if idempotency_key:
+        claimed, stored = claim_idempotency_key(user.id, idempotency_key)
+        if not claimed:
+            if stored is None:
+                busy = "This message is still being processed. Please wait a moment."
+                return jsonify({"error": busy, "reply": busy, "plan_ready": False}), 409
+            return jsonify(stored)
+
+        try:
+            result = run_chat_turn(user.id, conv_id, user_message)
+        except Exception:
+            release_idempotency_key(user.id, idempotency_key)
+            raise
+        store_idempotent_response(user.id, idempotency_key, result)
+        return jsonify(result)
+
+    # No key: identical requests that are in flight at the same time
+    # (double-clicks) still share one turn.
+    result = chat_flights.do(
+        (user.id, conv_id, user_message),
+        lambda: run_chat_turn(user.id, conv_id, user_message),
+    )
+    return jsonify(result)
+
+
+def run_chat_turn(user_id, conv_id, user_message):
+    """Store the user's message, ask the AI and store the reply.
+
+    Turns in one conversation are serialized (conversation_turn) so each
+    sees the previous turn's messages. Returns the JSON payload for
+    /api/chat.
+    """
+    check_usage_quota(user_id)
+
     conversation = None
     if conv_id:
         conversation = Conversation.query.filter_by(
-            id=conv_id, user_id=user.id
+            id=conv_id, user_id=user_id
         ).first()
 
     if not conversation:
         conversation = (
             Conversation.query
-            .filter_by(user_id=user.id)
+            .filter_by(user_id=user_id)
             .order_by(Conversation.updated_at.desc())
             .first()
         )
         if not conversation:
-            conversation = Conversation(user_id=user.id, title="New chat")
+            conversation = Conversation(user_id=user_id, title="New chat")
             db.session.add(conversation)
             db.session.commit()
 
+    with conversation_turn(conversation.id):
+        # Another turn may have committed while we waited for the claim.
+        db.session.refresh(conversation)
+        return answer_chat_message(user_id, conversation, user_message)
+
+
+def answer_chat_message(user_id, conversation, user_message):
     db_messages = (
         ChatMessage.query
-        .filter_by(user_id=user.id, conversation_id=conversation.id)
+        .filter_by(user_id=user_id, conversation_id=conversation.id)
         .order_by(ChatMessage.created_at)
         .all()
     )
     history = [{"role": m.role, "content": m.content} for m in db_messages]
 
     history.append({"role": "user", "content": user_message})
-    db_msg = ChatMessage(
-        user_id=user.id,
-        conversation_id=conversation.id,
-        role="user",
-        content=user_message
-    )
-    db.session.add(db_msg)
+    add_chat_message(conversation, user_id, "user", user_message)
 
     if conversation.title == "New chat":
         conversation.title = (user_message[:40] + "…") if len(user_message) > 40 else user_message
 
-    ai_text = call_ai_api(history).strip()
+    ai_text = call_ai_api(history, user_id=user_id, conversation_id=conversation.id).strip()
     bot_reply = ai_text
     plan_ready = False
 
@@ -777,7 +2134,7 @@ def chat_api():
                 steps = generate_learning_path(profile)
 
                 plan = LearningPlan(
-                    user_id=user.id,
+                    user_id=user_id,
                     goal=profile["goal"],
                     level=profile["level"],
                     hours_per_week=profile["hours_per_week"],
@@ -792,48 +2149,464 @@ def chat_api():
                     f"{profile['hours_per_week']} hours per week for {profile['duration_weeks']} weeks."
                 )
 
-                db_bot = ChatMessage(
-                    user_id=user.id,
-                    conversation_id=conversation.id,
-                    role="assistant",
-                    content=bot_reply,
-                )
-
-                conversation.updated_at = datetime.utcnow()
+                add_chat_message(conversation, user_id, "assistant", bot_reply)
+                conversation.plan = plan
 
                 db.session.add(plan)
-                db.session.add(db_bot)
                 db.session.commit()
 
-                return jsonify({
+                return {
                     "reply": bot_reply,
                     "plan_ready": plan_ready,
                     "conversation_id": conversation.id,
                     "plan_id": plan.id,   # ✅ specific plan ka id
-                })
+                }
         except Exception as e:
             print("JSON parse error or save error:", e, "RAW:", ai_text)
 
-    db_bot = ChatMessage(
-        user_id=user.id,
-        conversation_id=conversation.id,
-        role="assistant",
-        content=bot_reply,
-    )
-    conversation.updated_at = datetime.utcnow()
-    db.session.add(db_bot)
+    add_chat_message(conversation, user_id, "assistant", bot_reply)
     db.session.commit()
 
-    return jsonify({
+    return {
         "reply": bot_reply,
         "plan_ready": plan_ready,
         "conversation_id": conversation.id,
+    }
+
+# -------------------- Routes & CLI: Cohort Plans -------------------- #
+
+MAX_BATCH_PLANS = 1000
+
+
+@app.route("/api/plans/batch", methods=["POST"])
+@login_required
+def batch_plans_api():
+    user = current_user()
+    if not is_instructor(user):
+        return jsonify({"error": "Only instructors can create plans for a cohort."}), 403
+
+    data = request.get_json(force=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Send a JSON object."}), 400
+    items = data.get("plans")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Send a non-empty 'plans' list."}), 400
+    if len(items) > MAX_BATCH_PLANS:
+        return jsonify({"error": f"At most {MAX_BATCH_PLANS} plans per request."}), 400
+
+    created, unique_profiles, errors = create_plans_for_cohort(items)
+
+    return jsonify({
+        "created": created,
+        "unique_profiles": unique_profiles,
+        "errors": errors,
     })
 
+
+@app.cli.command("create-plans")
+@click.argument("cohort_file", type=click.File("r", encoding="utf-8"))
+def create_plans_command(cohort_file):
+    """Create learning plans for every learner listed in a JSON file.
+
+    The file holds a list of objects with `email`, `goal`, `level`,
+    `hours_per_week` and `duration_weeks`.
+    """
+    items = json.load(cohort_file)
+    if not isinstance(items, list):
+        raise click.ClickException("The cohort file must contain a JSON list.")
+
+    created, unique_profiles, errors = create_plans_for_cohort(items)
+
+    click.echo(
+        f"Created {len(created)} plans from {unique_profiles} unique profiles."
+    )
+    for err in errors:
+        click.echo(f"Skipped item {err['index']}: {err['error']}", err=True)
+
+# -------------------- Full-Text Search -------------------- #
+
+# SQLite FTS5 indexes kept in sync by triggers, so every insert/update made
+# through the ORM is indexed in the same transaction.
+# Plan topics are pulled out of path_json with json_each.
+PLAN_TOPICS_SQL = (
+    "(SELECT coalesce(group_concat(json_extract(value, '$.topic'), ' '), '') "
+    "FROM json_each({}.path_json))"
+)
+
+# One FTS5 table for every kind, so bm25 sees the same document counts and
+# term frequencies and scores of messages, conversations and plans compare.
+# Entry rowids are <source id> * 3 + kind code (0 message, 1 conversation,
+# 2 plan), which lets the triggers address a source row's entry directly.
+SEARCH_INDEX_CREATE = (
+    "CREATE VIRTUAL TABLE search_fts USING fts5("
+    "body, kind UNINDEXED, user_id UNINDEXED, conversation_id UNINDEXED)"
+)
+
+SEARCH_INDEX_BACKFILL = [
+    "INSERT INTO search_fts(rowid, body, kind, user_id, conversation_id) "
+    "SELECT id * 3, content, 'message', user_id, conversation_id FROM chat_messages",
+    "INSERT INTO search_fts(rowid, body, kind, user_id, conversation_id) "
+    "SELECT id * 3 + 1, title, 'conversation', user_id, id FROM conversations",
+    "INSERT INTO search_fts(rowid, body, kind, user_id, conversation_id) "
+    f"SELECT id * 3 + 2, goal || ' ' || {PLAN_TOPICS_SQL.format('learning_plans')}, "
+    "'plan', user_id, NULL FROM learning_plans",
+]
+
+SEARCH_INDEX_TRIGGERS = [
+    # chat_messages
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_search_ai AFTER INSERT ON chat_messages BEGIN "
+    "INSERT INTO search_fts(rowid, body, kind, user_id, conversation_id) "
+    "VALUES (new.id * 3, new.content, 'message', new.user_id, new.conversation_id); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_search_ad AFTER DELETE ON chat_messages BEGIN "
+    "DELETE FROM search_fts WHERE rowid = old.id * 3; END",
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_search_au AFTER UPDATE OF content ON chat_messages BEGIN "
+    "UPDATE search_fts SET body = new.content WHERE rowid = new.id * 3; END",
+    # conversations
+    "CREATE TRIGGER IF NOT EXISTS conversations_search_ai AFTER INSERT ON conversations BEGIN "
+    "INSERT INTO search_fts(rowid, body, kind, user_id, conversation_id) "
+    "VALUES (new.id * 3 + 1, new.title, 'conversation', new.user_id, new.id); END",
+    "CREATE TRIGGER IF NOT EXISTS conversations_search_ad AFTER DELETE ON conversations BEGIN "
+    "DELETE FROM search_fts WHERE rowid = old.id * 3 + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS conversations_search_au AFTER UPDATE OF title ON conversations BEGIN "
+    "UPDATE search_fts SET body = new.title WHERE rowid = new.id * 3 + 1; END",
+    # learning_plans
+    "CREATE TRIGGER IF NOT EXISTS learning_plans_search_ai AFTER INSERT ON learning_plans BEGIN "
+    "INSERT INTO search_fts(rowid, body, kind, user_id, conversation_id) "
+    f"VALUES (new.id * 3 + 2, new.goal || ' ' || {PLAN_TOPICS_SQL.format('new')}, "
+    "'plan', new.user_id, NULL); END",
+    "CREATE TRIGGER IF NOT EXISTS learning_plans_search_ad AFTER DELETE ON learning_plans BEGIN "
+    "DELETE FROM search_fts WHERE rowid = old.id * 3 + 2; END",
+    "CREATE TRIGGER IF NOT EXISTS learning_plans_search_au AFTER UPDATE OF goal, path_json ON learning_plans BEGIN "
+    f"UPDATE search_fts SET body = new.goal || ' ' || {PLAN_TOPICS_SQL.format('new')} "
+    "WHERE rowid = new.id * 3 + 2; END",
+]
+
+# The page is picked from rank alone; snippet() is the expensive part, so
+# it only runs for the rows of that page, looked up again by rowid (CROSS
+# JOIN keeps `page` as the outer loop).
+# FTS5 ranks are negative, lower is better.
+SEARCH_SQL = """
+WITH page AS (
+    SELECT rowid, rank FROM search_fts
+    WHERE search_fts MATCH :q AND user_id = :user_id
+    ORDER BY rank, rowid DESC
+    LIMIT :limit OFFSET :offset
+)
+SELECT search_fts.kind AS kind, search_fts.rowid / 3 AS id,
+       search_fts.conversation_id AS conversation_id,
+       snippet(search_fts, 0, '[', ']', '…', 12) AS snippet,
+       -page.rank AS score
+FROM page CROSS JOIN search_fts
+WHERE search_fts MATCH :q AND search_fts.rowid = page.rowid
+ORDER BY page.rank, page.rowid DESC
+"""
+
+
+def ensure_search_index(conn):
+    """Create the FTS5 table and triggers, backfilling it once."""
+    exists = conn.execute(db.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_fts'"
+    )).first()
+    if not exists:
+        conn.execute(db.text(SEARCH_INDEX_CREATE))
+        for backfill_sql in SEARCH_INDEX_BACKFILL:
+            conn.execute(db.text(backfill_sql))
+    for trigger_sql in SEARCH_INDEX_TRIGGERS:
+        conn.execute(db.text(trigger_sql))
+
+
+def build_fts_query(text):
+    # Quote every word so user input can never be parsed as FTS5 syntax,
+    # and make the last one a prefix match for search-as-you-type.
+    words = re.findall(r"\w+", text or "")
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+@app.route("/api/search")
+@login_required
+def search_api():
+    user = current_user()
+    fts_query = build_fts_query(request.args.get("q", ""))
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get("per_page", 20, type=int), 1), 50)
+
+    if not fts_query:
+        return jsonify({"results": [], "page": page, "has_more": False})
+
+    rows = db.session.execute(db.text(SEARCH_SQL), {
+        "q": fts_query,
+        "user_id": user.id,
+        # Fetch one extra row to know whether another page exists.
+        "limit": per_page + 1,
+        "offset": (page - 1) * per_page,
+    }, bind_arguments={"mapper": ChatMessage}).mappings().all()
+
+    results = [
+        {
+            "kind": row["kind"],
+            "id": row["id"],
+            "conversation_id": row["conversation_id"],
+            "snippet": row["snippet"],
+            "score": row["score"],
+        }
+        for row in rows[:per_page]
+    ]
+
+    return jsonify({
+        "results": results,
+        "page": page,
+        "has_more": len(rows) > per_page,
+    })
+
+# -------------------- Schema upgrades -------------------- #
+
+def add_missing_columns(conn, table, columns):
+    """ALTER TABLE ... ADD COLUMN for any of `columns` the table lacks.
+
+    db.create_all() never alters existing tables, so databases created before
+    a column was added need this. Returns the names that were added.
+    """
+    existing = {
+        row[1] for row in conn.execute(db.text(f"PRAGMA table_info({table})"))
+    }
+    added = []
+    for name, ddl in columns.items():
+        if name not in existing:
+            conn.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+            added.append(name)
+    return added
+
+
+def ensure_user_columns(conn):
+    add_missing_columns(conn, "users", {"shard": "INTEGER"})
+
+
+def ensure_conversation_summary(conn):
+    added = add_missing_columns(conn, "conversations", {
+        "last_message_preview": "VARCHAR(160)",
+        "message_count": "INTEGER NOT NULL DEFAULT 0",
+        "plan_id": "INTEGER REFERENCES learning_plans (id)",
+    })
+    conn.execute(db.text(
+        "CREATE INDEX IF NOT EXISTS ix_conversations_user_updated "
+        "ON conversations (user_id, updated_at)"
+    ))
+
+    if added:
+        # One-off backfill from chat_messages; chat_api keeps it current after this.
+        conn.execute(db.text(f"""
+            UPDATE conversations SET
+                message_count = (
+                    SELECT count(*) FROM chat_messages m
+                    WHERE m.conversation_id = conversations.id
+                ),
+                last_message_preview = (
+                    SELECT substr(replace(m.content, char(10), ' '), 1, {PREVIEW_LENGTH})
+                    FROM chat_messages m
+                    WHERE m.conversation_id = conversations.id
+                    ORDER BY m.created_at DESC, m.id DESC LIMIT 1
+                )
+        """))
+
+    add_missing_columns(conn, "conversations", {"turn_started_at": "DATETIME"})
+
+# -------------------- Shard Admin CLI -------------------- #
+
+# Per-user tables in copy order (parents first), with the columns that
+# point at rows copied earlier and must be remapped to their new ids.
+SHARD_COPY_ORDER = [
+    ("learning_plans", {}),
+    ("plan_revisions", {"plan_id": "learning_plans"}),
+    ("conversations", {"plan_id": "learning_plans"}),
+    ("chat_messages", {"conversation_id": "conversations"}),
+    ("chat_requests", {}),
+    ("llm_usage", {"conversation_id": "conversations"}),
+    ("llm_usage_hourly", {}),
+    ("ui_versions", {}),
+]
+
+
+def sharded_tables():
+    return [db.metadata.tables[name] for name, _ in SHARD_COPY_ORDER]
+
+
+def shard_locations():
+    """Every database that can hold per-user rows: None (main) plus the shards."""
+    if SHARD_DATABASES == 1:
+        return [None]
+    return [None] + list(range(SHARD_DATABASES))
+
+
+def user_rows(conn, table, user_id):
+    if "user_id" in table.c:
+        query = db.select(table).where(table.c.user_id == user_id)
+    else:
+        # plan_revisions only know their plan.
+        plans = db.metadata.tables["learning_plans"]
+        owned = db.select(plans.c.id).where(plans.c.user_id == user_id)
+        query = db.select(table).where(table.c.plan_id.in_(owned))
+    query = query.order_by(*table.primary_key.columns)
+    return [dict(row) for row in conn.execute(query).mappings()]
+
+
+def delete_user_rows(conn, user_id):
+    for table in reversed(sharded_tables()):
+        if "user_id" in table.c:
+            conn.execute(db.delete(table).where(table.c.user_id == user_id))
+        else:
+            plans = db.metadata.tables["learning_plans"]
+            owned = db.select(plans.c.id).where(plans.c.user_id == user_id)
+            conn.execute(db.delete(table).where(table.c.plan_id.in_(owned)))
+
+
+def move_user(user, target):
+    """Copy one user's rows to `target`, repoint the directory, then delete the old copy.
+
+    Row ids are reassigned in the target database, so plan and conversation
+    ids of a moved user change. Each step is its own transaction; re-running
+    after an interruption is safe because leftovers in the target are
+    cleared first.
+    """
+    source = user.shard
+    with shard_engine(source).connect() as src:
+        rows = {table.name: user_rows(src, table, user.id) for table in sharded_tables()}
+
+    with shard_engine(target).begin() as dst:
+        delete_user_rows(dst, user.id)
+        new_ids = {}
+        for table_name, remap in SHARD_COPY_ORDER:
+            table = db.metadata.tables[table_name]
+            ids = new_ids.setdefault(table_name, {})
+            for row in rows[table_name]:
+                old_id = row.pop("id", None)
+                for column, parent in remap.items():
+                    if row[column] is not None:
+                        row[column] = new_ids[parent].get(row[column])
+                result = dst.execute(db.insert(table).values(**row))
+                if old_id is not None:
+                    ids[old_id] = result.inserted_primary_key[0]
+        # Ids changed, so cached fragments for this user are stale.
+        dst.execute(bump_ui_versions_stmt([user.id]))
+
+    db.session.execute(
+        db.update(User)
+        .where(User.id == user.id)
+        .values(shard=target)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+    with shard_engine(source).begin() as src:
+        delete_user_rows(src, user.id)
+    return {name: len(r) for name, r in rows.items()}
+
+
+@app.cli.command("shard-stats")
+def shard_stats_command():
+    """Show how many users and rows each database holds."""
+    placement = {}
+    for shard, count in db.session.execute(
+        db.select(User.shard, db.func.count()).group_by(User.shard)
+    ):
+        placement[shard] = count
+
+    for shard in shard_locations():
+        label = "main" if shard is None else f"shard{shard}"
+        with shard_engine(shard).connect() as conn:
+            counts = ", ".join(
+                f"{table.name}={conn.execute(db.select(db.func.count()).select_from(table)).scalar()}"
+                for table in sharded_tables()
+            )
+        click.echo(f"{label:<8} users={placement.get(shard, 0)} {counts}")
+
+
+@app.cli.command("export-data")
+@click.argument("out_file", type=click.File("w", encoding="utf-8"))
+@click.option("--email", multiple=True, help="Only export these users (repeatable).")
+def export_data_command(out_file, email):
+    """Write every user's chats and plans, across all shards, as JSON lines."""
+    query = User.query.order_by(User.id)
+    if email:
+        query = query.filter(User.email.in_([e.strip().lower() for e in email]))
+
+    exported = 0
+    for user in query.yield_per(200):
+        with shard_engine(user.shard).connect() as conn:
+            record = {
+                "id": user.id,
+                "name": user.name,
+                "email": user.email,
+                "shard": user.shard,
+            }
+            for table in sharded_tables():
+                record[table.name] = user_rows(conn, table, user.id)
+        out_file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        exported += 1
+    click.echo(f"Exported {exported} users.", err=True)
+
+
+@app.cli.command("rebalance-shards")
+@click.option("--email", help="Move only this user.")
+@click.option("--to", "target", type=int, help="Target shard for --email (default: hash placement).")
+@click.option("--dry-run", is_flag=True, help="Only list the moves.")
+def rebalance_shards_command(email, target, dry_run):
+    """Move users whose data is not on their hash-assigned shard.
+
+    Covers users created before sharding was enabled and changes to
+    SHARD_COUNT. Run it while the affected users are idle: writes made
+    during a move can be lost.
+    """
+    if target is not None and not email:
+        raise click.ClickException("--to needs --email.")
+    if target is not None and not 0 <= target < SHARD_COUNT:
+        raise click.ClickException(f"--to must be between 0 and {SHARD_COUNT - 1}.")
+
+    query = User.query.order_by(User.id)
+    if email:
+        query = query.filter_by(email=email.strip().lower())
+    users = query.all()
+    if email and not users:
+        raise click.ClickException(f"Unknown user {email}.")
+
+    moved = 0
+    for user in users:
+        destination = target if target is not None else shard_for_user(user.id)
+        if destination == user.shard:
+            continue
+        click.echo(f"{user.email}: {user.shard} -> {destination}")
+        if not dry_run:
+            copied = move_user(user, destination)
+            click.echo("  " + ", ".join(f"{k}={v}" for k, v in copied.items()))
+        moved += 1
+    click.echo(f"{'Would move' if dry_run else 'Moved'} {moved} users.")
+
 # -------------------- Create tables -------------------- #
 
 with app.app_context():
     db.create_all()
+    with db.engine.begin() as conn:
+        ensure_user_columns(conn)
+        ensure_conversation_summary(conn)
+        ensure_search_index(conn)
+    # Refuse to start rather than fail on every request for users whose
+    # shard is not open (SHARD_COUNT lowered without SHARD_DATABASES).
+    highest = db.session.execute(db.select(db.func.max(User.shard))).scalar()
+    if highest is not None and highest >= SHARD_DATABASES:
+        raise RuntimeError(
+            f"Users are stored on shard {highest}, but only {SHARD_DATABASES} shard "
+            f"databases are configured. Set SHARD_DATABASES={highest + 1} and run "
+            "`flask rebalance-shards` to move them."
+        )
+    for shard in range(SHARD_DATABASES if SHARD_DATABASES > 1 else 0):
+        engine = shard_engine(shard)
+        db.metadata.create_all(engine, tables=sharded_tables())
+        with engine.begin() as conn:
+            ensure_conversation_summary(conn)
+            ensure_search_index(conn)
 
 if __name__ == "__main__":
     # Disable the reloader to keep a single process (easier to run inside this environment)
@@ -0,0 +1,201 @@
+"""Login throughput load test.
+
+Starts the app on a throwaway SQLite database in a threaded local server
+(or with --gunicorn, the Procfile's gunicorn command), creates test users,
+then fires concurrent POST /login requests while a
+background client keeps sending /api/chat messages. Prints login throughput,
+login latency percentiles, rate-limit/busy rejections and chat latency
+during the burst.
+
+Usage (from the project folder):
+    python benchmarks/login_load.py --users 200 --concurrency 32
+    python benchmarks/login_load.py --with-limits   # keep the default rate limits
+    python benchmarks/login_load.py --gunicorn      # serve with the Procfile command
+"""
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = "LoadTest123"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # A successful login is the 302 itself; don't also render the dashboard.
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def make_opener():
+    jar = http.cookiejar.CookieJar()
+    return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar), NoRedirect())
+
+
+def post_form(opener, url, fields):
+    data = urllib.parse.urlencode(fields).encode()
+    try:
+        with opener.open(url, data=data) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def start_gunicorn(port):
+    """Run the Procfile's web command on `port`; returns the process."""
+    with open(os.path.join(ROOT, "Procfile"), encoding="utf-8") as f:
+        command = next(line for line in f if line.startswith("web:"))[len("web:"):]
+    argv = shlex.split(command.replace("$PORT", str(port)))
+    proc = subprocess.Popen(argv, cwd=ROOT, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("gunicorn did not start: " + " ".join(argv))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LearnPath login load test")
+    parser.add_argument("--users", type=int, default=200, help="number of logins to send")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--with-limits", action="store_true",
+                        help="keep the default per-IP/per-email rate limits")
+    parser.add_argument("--gunicorn", action="store_true",
+                        help="serve with the gunicorn command from the Procfile")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tmp, "load.db")
+    os.environ["GEMINI_API_KEY"] = ""
+    if not args.with_limits:
+        os.environ.setdefault("AUTH_IP_BURST", "1000000")
+        os.environ.setdefault("AUTH_IP_PER_MINUTE", "1000000")
+
+    import app as learnpath
+    from werkzeug.serving import make_server
+
+    base = f"http://127.0.0.1:{args.port}"
+    with learnpath.app.app_context():
+        shared_hash = learnpath.hash_password(PASSWORD)
+        for i in range(args.users):
+            learnpath.db.session.add(learnpath.User(
+                name=f"Load {i}", email=f"load{i}@example.com", password_hash=shared_hash,
+            ))
+        learnpath.db.session.add(learnpath.User(
+            name="Chatter", email="chatter@example.com", password_hash=shared_hash,
+        ))
+        learnpath.db.session.commit()
+
+    if args.gunicorn:
+        server = start_gunicorn(args.port)
+    else:
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", args.port, learnpath.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    chatter = make_opener()
+    post_form(chatter, f"{base}/login", {"email": "chatter@example.com", "password": PASSWORD})
+
+    stop = threading.Event()
+    chat_latencies = []
+
+    def chat_loop():
+        while not stop.is_set():
+            req = urllib.request.Request(
+                f"{base}/api/chat",
+                data=json.dumps({"message": "How are you?"}).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+            start = time.perf_counter()
+            try:
+                chatter.open(req).read()
+            except urllib.error.URLError:
+                pass
+            chat_latencies.append(time.perf_counter() - start)
+
+    login_latencies = []
+    statuses = {}
+    results_lock = threading.Lock()
+    next_user = iter(range(args.users))
+    next_lock = threading.Lock()
+
+    def login_worker():
+        while True:
+            with next_lock:
+                i = next(next_user, None)
+            if i is None:
+                return
+            opener = make_opener()
+            start = time.perf_counter()
+            status = post_form(opener, f"{base}/login",
+                               {"email": f"load{i}@example.com", "password": PASSWORD})
+            elapsed = time.perf_counter() - start
+            with results_lock:
+                login_latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    chat_thread = threading.Thread(target=chat_loop, daemon=True)
+    chat_thread.start()
+    time.sleep(0.5)
+    idle_chat = list(chat_latencies)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=login_worker) for _ in range(args.concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    duration = time.perf_counter() - started
+
+    stop.set()
+    chat_thread.join(timeout=5)
+    burst_chat = chat_latencies[len(idle_chat):]
+    if args.gunicorn:
+        server.terminate()
+        server.wait()
+    else:
+        server.shutdown()
+
+    print(f"Hash method:       {learnpath.CURRENT_HASH_PREFIX} "
+          f"({learnpath.PASSWORD_HASH_WORKERS} hash workers)")
+    print(f"Logins:            {args.users} in {duration:.2f}s "
+          f"-> {args.users / duration:.1f} logins/s")
+    print(f"Login latency:     p50 {statistics.median(login_latencies) * 1000:.0f} ms, "
+          f"p95 {percentile(login_latencies, 95) * 1000:.0f} ms")
+    print(f"Status codes:      {dict(sorted(statuses.items()))}")
+    if idle_chat:
+        print(f"Chat latency idle: p50 {statistics.median(idle_chat) * 1000:.1f} ms")
+    if burst_chat:
+        print(f"Chat during burst: p50 {statistics.median(burst_chat) * 1000:.1f} ms, "
+              f"p95 {percentile(burst_chat, 95) * 1000:.1f} ms ({len(burst_chat)} requests)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Micro-benchmarks for the pure, CPU-bound functions on the request path.
+
+Covers generate_learning_path, suggest_resources, call_ai_api_stub,
+detect_goal_from_text and detect_programming_language over synthetic
+catalogues (100 to 100k resources) and conversations (1 to 500 turns).
+
+Usage (from the project folder):
+    python benchmarks/run_benchmarks.py              # compare with baseline.json
+    python benchmarks/run_benchmarks.py --save       # record a new baseline
+    python benchmarks/run_benchmarks.py --quick      # skip the largest sizes
+
+Each result is the median, over several timed runs, of the call time
+divided by a fixed pure-Python calibration loop timed right after it, so a
+baseline recorded on one machine is still meaningful on another. Results
+in baseline.json are stored in those calibration units. The script exits with
+status 1 when any benchmark is slower than the baseline by more than
+--threshold (default 30%) and by more than NOISE_FLOOR_SECONDS in absolute
+terms, so timer jitter on microsecond-scale calls cannot fail the gate.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep the benchmarks away from instance/learning_path.db and the real API.
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ["GEMINI_API_KEY"] = ""
+
+import app as learnpath  # noqa: E402
+from ranking import ResourceIndex  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+CATALOGUE_SIZES = [100, 1_000, 10_000, 100_000]
+TURN_COUNTS = [1, 10, 100, 500]
+QUICK_CATALOGUE_SIZES = [100, 1_000]
+QUICK_TURN_COUNTS = [1, 10, 100]
+
+# Slowdowns smaller than this (per call, after calibration) are noise.
+NOISE_FLOOR_SECONDS = 2e-6
+
+TOPIC_WORDS = [
+    "python", "javascript", "web", "frontend", "backend", "data", "analysis",
+    "sql", "databases", "machine", "learning", "rust", "go", "java", "design",
+    "cloud", "docker", "testing", "security", "practice", "project", "api",
+]
+GOALS = ["Python Programming", "Web Development", "Data Analysis", "Machine Learning", "SQL and Databases"]
+LEVELS = ["beginner", "intermediate", "advanced", "all"]
+
+USER_LINES = [
+    "Hi, how are you?",
+    "I have been a bit bored lately and wasting time on my phone.",
+    "I want to learn something useful, maybe web development or python.",
+    "I think I am a beginner, I only know some basic HTML.",
+    "I can study around 6 hours per week for 5 weeks.",
+]
+ASSISTANT_LINE = "That sounds good! Tell me a bit more so I can help you plan."
+
+
+def make_catalogue(size, seed=1):
+    rng = random.Random(seed)
+    catalogue = []
+    for i in range(size):
+        cats = rng.sample(GOALS, 1) + [w.title() for w in rng.sample(TOPIC_WORDS, 2)]
+        catalogue.append({
+            "id": f"res_{i}",
+            "categories": cats,
+            "level": rng.choice(LEVELS),
+            "type": rng.choice(["video", "text", "practice"]),
+            "title": " ".join(rng.sample(TOPIC_WORDS, 4)).title() + f" #{i}",
+            "url": f"https://example.com/resource/{i}",
+            "note": " ".join(rng.sample(TOPIC_WORDS, 6)),
+        })
+    return catalogue
+
+
+def make_history(turns):
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": USER_LINES[i % len(USER_LINES)]})
+        history.append({"role": "assistant", "content": ASSISTANT_LINE})
+    # call_ai_api_stub is always called with the user's message last.
+    history[-1] = {"role": "user", "content": USER_LINES[(turns - 1) % len(USER_LINES)]}
+    return history
+
+
+def calibration_work():
+    """Fixed pure-Python workload used to normalize results."""
+    total = 0
+    for i in range(200_000):
+        total += i % 7
+    return total
+
+
+def time_loop(fn, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return time.perf_counter() - start
+
+
+def calibrate(repeat=9):
+    """Median time of one calibration_work() call, in seconds."""
+    return statistics.median(time_loop(calibration_work, 1) for _ in range(repeat))
+
+
+def measure(fn, min_time=0.2, repeat=9):
+    """Median per-call time of fn in calibration units.
+
+    Every repeat is followed by one calibration run, so a CPU that speeds up
+    or slows down during the suite shifts both sides of each ratio alike.
+    """
+    number = 1
+    while True:
+        elapsed = time_loop(fn, number)
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    ratios = []
+    for _ in range(repeat):
+        per_call = time_loop(fn, number) / number
+        ratios.append(per_call / time_loop(calibration_work, 1))
+    return statistics.median(ratios)
+
+
+def collect_benchmarks(catalogue_sizes, turn_counts):
+    """Yield (name, catalogue_size, make_fn) triples.
+
+    `catalogue_size` is the resource catalogue the benchmark needs (None if
+    it does not use one); make_fn() returns the callable to time.
+    """
+    profile = {
+        "goal": "Python Programming",
+        "level": "Beginner",
+        "hours_per_week": 6,
+        "duration_weeks": 6,
+    }
+
+    for size in catalogue_sizes:
+        yield f"suggest_resources[{size}]", size, lambda: (
+            lambda: learnpath.suggest_resources(
+                "Python Programming", "beginner", "Core Concepts & Practice"
+            )
+        )
+        yield f"generate_learning_path[{size}]", size, lambda: (
+            lambda: learnpath.generate_learning_path(profile)
+        )
+
+    for turns in turn_counts:
+        history = make_history(turns)
+        text = " ".join(m["content"] for m in history if m["role"] == "user")
+
+        yield f"call_ai_api_stub[{turns}]", None, lambda history=history: (
+            lambda: learnpath.call_ai_api_stub(history)
+        )
+        yield f"detect_goal_from_text[{turns}]", None, lambda text=text: (
+            lambda: learnpath.detect_goal_from_text(text)
+        )
+        yield f"detect_programming_language[{turns}]", None, lambda text=text: (
+            lambda: learnpath.detect_programming_language(text)
+        )
+
+
+def run(catalogue_sizes, turn_counts, calibration, only=None):
+    original_index = learnpath.RESOURCE_INDEX
+    indexes = {}
+    results = {}
+    try:
+        for name, size, make_fn in collect_benchmarks(catalogue_sizes, turn_counts):
+            if only and only not in name:
+                continue
+            if size is None:
+                learnpath.RESOURCE_INDEX = original_index
+            else:
+                # Built only for selected benchmarks, once per size.
+                if size not in indexes:
+                    indexes[size] = ResourceIndex(make_catalogue(size))
+                learnpath.RESOURCE_INDEX = indexes[size]
+            results[name] = measure(make_fn())
+            print(f"  {name:<40} {results[name] * calibration * 1e6:12.1f} us")
+    finally:
+        learnpath.RESOURCE_INDEX = original_index
+    return results
+
+
+def compare(results, calibration, baseline, threshold):
+    regressions = []
+    for name, units in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"  {name:<40} (no baseline)")
+            continue
+        ratio = units / base
+        slowdown = (units - base) * calibration
+        marker = ""
+        if ratio > 1 + threshold and slowdown > NOISE_FLOOR_SECONDS:
+            marker = "  <-- REGRESSION"
+            regressions.append((name, ratio))
+        print(f"  {name:<40} {ratio:6.2f}x baseline{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LearnPath micro-benchmarks")
+    parser.add_argument("--save", action="store_true", help="write results to baseline.json")
+    parser.add_argument("--quick", action="store_true", help="skip the largest sizes")
+    parser.add_argument("--threshold", type=float, default=0.30,
+                        help="allowed slowdown before failing (0.25 = 25%%)")
+    parser.add_argument("-k", dest="only", help="only run benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    catalogue_sizes = QUICK_CATALOGUE_SIZES if args.quick else CATALOGUE_SIZES
+    turn_counts = QUICK_TURN_COUNTS if args.quick else TURN_COUNTS
+
+    calibration = calibrate()
+    print(f"Calibration: {calibration * 1e3:.2f} ms")
+    results = run(catalogue_sizes, turn_counts, calibration, args.only)
+
+    if args.save:
+        baseline = {"calibration": calibration, "results": results}
+        if os.path.exists(BASELINE_FILE) and (args.quick or args.only):
+            # Partial runs only update the entries they measured.
+            with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+                old = json.load(f)
+            merged = dict(old["results"])
+            merged.update(results)
+            baseline["results"] = merged
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline to {BASELINE_FILE}")
+        return 0
+
+    if not os.path.exists(BASELINE_FILE):
+        print("No baseline.json yet; run with --save to create one.")
+        return 0
+
+    with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    print(f"\nCompared with baseline (threshold {args.threshold:.0%}):")
+    regressions = compare(results, calibration, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed.")
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
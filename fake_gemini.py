@@ -0,0 +1,189 @@
+"""Local fake Gemini server that replays recorded LLM calls.
+
+Use it to run the full chat pipeline offline, at realistic latency, without
+a real API key.
+
+1) Record a cassette while using the app against the real model (or the
+   stub) by setting `LLM_RECORD_FILE`:
+       LLM_RECORD_FILE=llm_cassette.jsonl python app.py
+
+2) Start the fake server with that recording:
+       python fake_gemini.py llm_cassette.jsonl --port 8765
+
+3) Point the app at it (any non-empty key works):
+       GEMINI_API_KEY=fake GEMINI_BASE_URL=http://127.0.0.1:8765 python app.py
+
+Prompts are matched exactly against the recording. Unknown prompts get the
+recorded responses in file order (or a 404 with `--strict`), so repeated runs
+see the same replies.
+
+Latency options:
+    recorded             sleep for the latency measured when recording (default)
+    fixed:MS             always sleep MS milliseconds
+    uniform:LO,HI        uniform between LO and HI milliseconds
+    normal:MEAN,STD      normal distribution, clipped at 0
+    lognormal:MU,SIGMA   lognormal distribution (parameters of ln(ms))
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GENERATE_PATH = re.compile(r"/models/(?P<model>[^/:]+):generateContent$")
+
+
+def load_cassette(path):
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+
+def make_latency_sampler(spec, seed):
+    """Return a function entry -> seconds for the given latency spec."""
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    kind, _, params = spec.partition(":")
+    values = [float(p) for p in params.split(",") if p]
+
+    if kind == "recorded":
+        return lambda entry: max(entry.get("latency_ms", 0.0), 0.0) / 1000
+
+    if kind == "fixed" and len(values) == 1:
+        draw = lambda: values[0]
+    elif kind == "uniform" and len(values) == 2:
+        draw = lambda: rng.uniform(values[0], values[1])
+    elif kind == "normal" and len(values) == 2:
+        draw = lambda: rng.gauss(values[0], values[1])
+    elif kind == "lognormal" and len(values) == 2:
+        draw = lambda: rng.lognormvariate(values[0], values[1])
+    else:
+        raise ValueError(f"Unknown latency spec: {spec}")
+
+    def sample(entry):
+        # Serialize draws so a fixed seed gives the same sequence.
+        with lock:
+            return max(draw(), 0.0) / 1000
+
+    return sample
+
+
+def extract_prompt(body):
+    # google-genai sends a plain string `contents` as one user turn.
+    parts = []
+    for content in body.get("contents", []):
+        for part in content.get("parts", []):
+            if "text" in part:
+                parts.append(part["text"])
+    return "".join(parts)
+
+
+def gemini_response(text, model, prompt):
+    return {
+        "candidates": [
+            {
+                "content": {"role": "model", "parts": [{"text": text}]},
+                "finishReason": "STOP",
+                "index": 0,
+            }
+        ],
+        "usageMetadata": {
+            # Rough 4-chars-per-token estimate; good enough for load tests.
+            "promptTokenCount": len(prompt) // 4,
+            "candidatesTokenCount": len(text) // 4,
+            "totalTokenCount": (len(prompt) + len(text)) // 4,
+        },
+        "modelVersion": model,
+    }
+
+
+class Replayer:
+    def __init__(self, entries, latency, strict):
+        self.by_prompt = {}
+        for entry in entries:
+            self.by_prompt.setdefault(entry["prompt"], entry)
+        self.sequence = itertools.cycle(entries) if entries else None
+        self.sequence_lock = threading.Lock()
+        self.latency = latency
+        self.strict = strict
+
+    def lookup(self, prompt):
+        entry = self.by_prompt.get(prompt)
+        if entry is not None or self.strict or self.sequence is None:
+            return entry
+        with self.sequence_lock:
+            return next(self.sequence)
+
+
+def make_handler(replayer):
+    class FakeGeminiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            match = GENERATE_PATH.search(self.path.split("?", 1)[0])
+            length = int(self.headers.get("Content-Length", 0))
+            raw = self.rfile.read(length) if length else b"{}"
+
+            if not match:
+                return self.send_json(404, {"error": {"code": 404, "message": "Unknown endpoint"}})
+
+            try:
+                body = json.loads(raw or b"{}")
+            except json.JSONDecodeError:
+                return self.send_json(400, {"error": {"code": 400, "message": "Invalid JSON"}})
+
+            prompt = extract_prompt(body)
+            entry = replayer.lookup(prompt)
+            if entry is None:
+                return self.send_json(404, {"error": {"code": 404, "message": "Prompt not in cassette"}})
+
+            time.sleep(replayer.latency(entry))
+            self.send_json(200, gemini_response(entry["response"], match.group("model"), prompt))
+
+        def send_json(self, status, payload):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return FakeGeminiHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cassette", help="JSONL file written with LLM_RECORD_FILE")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="recorded", help="latency spec (see module docstring)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for latency distributions")
+    parser.add_argument("--strict", action="store_true", help="404 for prompts not in the cassette")
+    args = parser.parse_args()
+
+    entries = load_cassette(args.cassette)
+    replayer = Replayer(entries, make_latency_sampler(args.latency, args.seed), args.strict)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(replayer))
+    print(f"Fake Gemini replaying {len(entries)} calls on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""TF-IDF ranking of learning resources.
+
+The catalogue from data/resources.json is turned once into a sparse TF-IDF
+matrix over each resource's title, note and categories. A goal/topic query
+is then scored against every resource with a single sparse matrix-vector
+product, so ranking stays fast for large catalogues. Everything runs
+locally with NumPy/SciPy; there are no network calls.
+"""
+import math
+import re
+
+import numpy as np
+from scipy import sparse
+
+TOKEN_RE = re.compile(r"[a-z0-9+#]+")
+
+STOPWORDS = {
+    "a", "an", "and", "the", "of", "in", "on", "for", "to", "with", "from",
+    "by", "or", "&", "–", "-", "your", "you", "is", "are", "it", "this",
+}
+
+# Categories are the curated signal, so they count more than free text.
+CATEGORY_WEIGHT = 3
+# The goal decides what a plan is about; the weekly topic refines it.
+GOAL_WEIGHT = 2.0
+TOPIC_WEIGHT = 1.0
+
+# Drop candidates scoring below this fraction of the best hit, so a shared
+# generic word (e.g. "programming") does not pull in other languages.
+MIN_RELATIVE_SCORE = 0.35
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall((text or "").lower()) if t not in STOPWORDS]
+
+
+def resource_tokens(resource):
+    tokens = tokenize(resource.get("title")) + tokenize(resource.get("note"))
+    for cat in resource.get("categories", []):
+        tokens += tokenize(cat) * CATEGORY_WEIGHT
+    return tokens
+
+
+class ResourceIndex:
+    """Precomputed TF-IDF matrix for a list of resource dicts."""
+
+    def __init__(self, resources):
+        self.resources = list(resources)
+        self.vocab = {}
+
+        rows, cols, counts = [], [], []
+        for row, resource in enumerate(self.resources):
+            tf = {}
+            for token in resource_tokens(resource):
+                col = self.vocab.setdefault(token, len(self.vocab))
+                tf[col] = tf.get(col, 0) + 1
+            rows.extend([row] * len(tf))
+            cols.extend(tf.keys())
+            counts.extend(tf.values())
+
+        n_docs = len(self.resources)
+        shape = (n_docs, len(self.vocab))
+        tf_matrix = sparse.csr_matrix(
+            (np.asarray(counts, dtype=np.float64), (rows, cols)), shape=shape
+        )
+
+        df = np.bincount(np.asarray(cols, dtype=np.int64), minlength=len(self.vocab))
+        self.idf = np.log((1 + n_docs) / (1 + df)) + 1.0
+
+        matrix = tf_matrix.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        self.matrix = sparse.diags(1.0 / norms).dot(matrix).tocsr()
+
+        self.levels = np.array(
+            [(r.get("level") or "all").lower() for r in self.resources], dtype=object
+        )
+        self.ids = [r.get("id") or r.get("url") or r.get("title") for r in self.resources]
+        self._level_masks = {}
+
+    def level_mask(self, lvl):
+        mask = self._level_masks.get(lvl)
+        if mask is None:
+            mask = (self.levels == "all") | (self.levels == lvl)
+            self._level_masks[lvl] = mask
+        return mask
+
+    def query_vector(self, weighted_texts):
+        q = np.zeros(len(self.vocab))
+        for text, weight in weighted_texts:
+            for token in tokenize(text):
+                col = self.vocab.get(token)
+                if col is not None:
+                    q[col] += weight * self.idf[col]
+        norm = math.sqrt(float(q.dot(q)))
+        return q / norm if norm else q
+
+    def score(self, goal, topic):
+        """Cosine similarity of every resource against goal + topic."""
+        if not self.resources or not self.vocab:
+            return np.zeros(len(self.resources))
+        q = self.query_vector([(goal, GOAL_WEIGHT), (topic, TOPIC_WEIGHT)])
+        return self.matrix.dot(q)
+
+    def rank(self, goal, level, topic, k=3, exclude=None, min_results=2):
+        """Indices of the top-k resources for a goal/level/topic.
+
+        Resources whose id is in `exclude` (already used in earlier weeks)
+        are only used to top the list up to `min_results`.
+        """
+        scores = self.score(goal, topic)
+        if not len(scores):
+            return []
+
+        lvl = (level or "").lower()
+        if lvl:
+            scores = np.where(self.level_mask(lvl), scores, 0.0)
+
+        best = scores.max()
+        if best <= 0:
+            return []
+
+        candidates = np.flatnonzero(scores >= best * MIN_RELATIVE_SCORE)
+        # Best first; ties keep catalogue order.
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        exclude = exclude or set()
+        fresh, used = [], []
+        for i in candidates:
+            if self.ids[i] not in exclude:
+                fresh.append(i)
+                if len(fresh) >= k:
+                    break
+            elif len(used) < min_results:
+                used.append(i)
+
+        chosen = fresh
+        if len(chosen) < min_results:
+            chosen += used[:min_results - len(chosen)]
+        return [int(i) for i in chosen]